@@ -2,7 +2,9 @@ import logging
 import sys
 
 import environ
+import pyarrow as pa
 from configurator import Configurator
+from parquet_compactor import ARROW_IO_THREADS
 from parquet_compactor import S3ParquetCompactor
 
 root = logging.getLogger()
@@ -33,6 +35,7 @@ def main():
         s3_bucket_name
     )
 
+    pa.set_io_thread_count(ARROW_IO_THREADS)
     compactor = S3ParquetCompactor(
         S3_BUCKET,
         S3_ENDPOINT,
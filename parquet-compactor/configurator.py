@@ -1,6 +1,4 @@
 import environ
-from app_common_python import LoadedConfig
-from app_common_python import ObjectBuckets
 
 ENVIRONMENT = environ.Env()
 
@@ -71,14 +69,18 @@ class EnvConfigurator:
 
 
 class ClowderConfigurator:
-    """Establish S3 credentials via Clowder."""
+    """Establish S3 credentials via Clowder.
+
+    app_common_python parses the Clowder config when it is imported, so it
+    is only imported once one of these methods is called.
+    """
 
     @staticmethod
     def get_object_store_endpoint():
         """Obtain object store endpoint."""
-        S3_SECURE = CLOWDER_CONFIGURATOR.get_object_store_tls()
-        S3_HOST = CLOWDER_CONFIGURATOR.get_object_store_host()
-        S3_PORT = CLOWDER_CONFIGURATOR.get_object_store_port()
+        S3_SECURE = ClowderConfigurator.get_object_store_tls()
+        S3_HOST = ClowderConfigurator.get_object_store_host()
+        S3_PORT = ClowderConfigurator.get_object_store_port()
 
         S3_PREFIX = "https://" if S3_SECURE else "http://"
         endpoint = f"{S3_PREFIX}{S3_HOST}"
@@ -89,16 +91,22 @@ class ClowderConfigurator:
     @staticmethod
     def get_object_store_host():
         """Obtain object store host."""
+        from app_common_python import LoadedConfig
+
         return LoadedConfig.objectStore.hostname
 
     @staticmethod
     def get_object_store_port():
         """Obtain object store port."""
+        from app_common_python import LoadedConfig
+
         return LoadedConfig.objectStore.port
 
     @staticmethod
     def get_object_store_tls():
         """Obtain object store secret key."""
+        from app_common_python import LoadedConfig
+
         value = LoadedConfig.objectStore.tls
         if type(value) == bool:
             return value
@@ -107,29 +115,39 @@ class ClowderConfigurator:
         else:
             return False
 
+    @staticmethod
+    def _resolve_bucket_attr(requestedName, attr):
+        """Obtain a bucket attribute, falling back to the object store."""
+        from app_common_python import LoadedConfig
+        from app_common_python import ObjectBuckets
+
+        bucket = ObjectBuckets.get(requestedName) if requestedName else None
+        if bucket:
+            return getattr(bucket, attr)
+        buckets = LoadedConfig.objectStore.buckets
+        if len(buckets) > 0:
+            return getattr(buckets[0], attr)
+        return getattr(LoadedConfig.objectStore, attr) or None
+
     @staticmethod
     def get_object_store_access_key(requestedName: str = ""):
         """Obtain object store access key."""
-        if requestedName != "" and ObjectBuckets.get(requestedName):
-            return ObjectBuckets.get(requestedName).accessKey
-        if len(LoadedConfig.objectStore.buckets) > 0:
-            return LoadedConfig.objectStore.buckets[0].accessKey
-        if LoadedConfig.objectStore.accessKey:
-            return LoadedConfig.objectStore.accessKey
+        return ClowderConfigurator._resolve_bucket_attr(
+            requestedName, "accessKey"
+        )
 
     @staticmethod
     def get_object_store_secret_key(requestedName: str = ""):
         """Obtain object store secret key."""
-        if requestedName != "" and ObjectBuckets.get(requestedName):
-            return ObjectBuckets.get(requestedName).secretKey
-        if len(LoadedConfig.objectStore.buckets) > 0:
-            return LoadedConfig.objectStore.buckets[0].secretKey
-        if LoadedConfig.objectStore.secretKey:
-            return LoadedConfig.objectStore.secretKey
+        return ClowderConfigurator._resolve_bucket_attr(
+            requestedName, "secretKey"
+        )
 
     @staticmethod
     def get_object_store_bucket(requestedName: str = ""):
         """Obtain object store bucket."""
+        from app_common_python import ObjectBuckets
+
         if ObjectBuckets.get(requestedName):
             return ObjectBuckets.get(requestedName).name
         return requestedName
@@ -137,6 +155,3 @@ class ClowderConfigurator:
     @staticmethod
     def get_data_prefix():
         return ENVIRONMENT.get_value("S3_DATA_PREFIX", default="data/parquet/")
-
-
-CLOWDER_CONFIGURATOR = ClowderConfigurator()
@@ -1,31 +1,96 @@
 import datetime
-import gc
+import heapq
 import logging
 import re
 import uuid
 from collections import defaultdict
+from concurrent.futures import as_completed
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from functools import cached_property
+from operator import attrgetter
 
-import awswrangler as wr
 import boto3
 import environ
-from awswrangler.exceptions import EmptyDataFrame
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
 from dateutil.relativedelta import relativedelta
 from pyarrow import ArrowException
+from pyarrow.fs import AwsStandardS3RetryStrategy
+from pyarrow.fs import S3FileSystem
 
 
 ENV = environ.Env()
 LOG = logging.getLogger(__name__)
 
-CHUNKED_ROWS = ENV.int("CHUNKED_ROWS", default=1_000_000)
+ROW_GROUP_ROWS = ENV.int("ROW_GROUP_ROWS", default=1024 * 1024)
 TARGET_FILE_SIZE_GB = ENV.float("TARGET_FILE_SIZE_GB", default=0.3)
-FILE_SIZE_BYTES = TARGET_FILE_SIZE_GB * pow(2, 30)
+# Thresholds are whole byte counts, so the per-file comparisons against S3
+# object sizes and stream offsets stay integer comparisons
+FILE_SIZE_BYTES = int(TARGET_FILE_SIZE_GB * pow(2, 30))
+# Files this close to the target are not worth rewriting
+COMPACTED_FILE_SIZE_BYTES = FILE_SIZE_BYTES * 4 // 5
+# Input bytes packed into one split. The writer starts a new file whenever
+# the output reaches FILE_SIZE_BYTES, so a split several targets wide still
+# fills whole files when the output compresses better than the input.
+SPLIT_SIZE_BYTES = FILE_SIZE_BYTES * ENV.int("SPLIT_SIZE_FILES", default=4)
+# Paths whose mergeable files add up to less than this are left alone.
+# Disabled by default: a leaf that never grows past the threshold would
+# otherwise never be compacted.
+MIN_COMPACTION_BYTES = ENV.int("MIN_COMPACTION_BYTES", default=0)
+COMPACTION_WORKERS = ENV.int("COMPACTION_WORKERS", default=8)
+# Rows per scanned record batch. Together with the readahead settings below
+# this bounds how much decoded data a merge holds in memory at once.
+SCAN_BATCH_ROWS = 64 * 1024
+# How far the scanner reads ahead of the writer, in batches within a file and
+# in files within a merge. Raising these trades memory for overlap.
+SCAN_BATCH_READAHEAD = ENV.int("SCAN_BATCH_READAHEAD", default=16)
+SCAN_FRAGMENT_READAHEAD = ENV.int("SCAN_FRAGMENT_READAHEAD", default=4)
+# Arrow issues the pre-buffered reads of every concurrent merge on one
+# shared I/O thread pool, which defaults to only 8 threads. The pool is
+# process-wide, so app.py sizes it once at startup.
+ARROW_IO_THREADS = ENV.int(
+    "ARROW_IO_THREADS", default=COMPACTION_WORKERS * SCAN_FRAGMENT_READAHEAD
+)
+# Splits of one path merged at once. Above 1 this overlaps one split's
+# upload with the next split's reads, but multiplies the merges in flight,
+# and so the scanner readahead memory, by the same factor.
+SPLIT_WORKERS = ENV.int("SPLIT_WORKERS", default=1)
+# S3 accepts at most 1000 keys per DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+S3_MAX_POOL_CONNECTIONS = 64
+S3_MAX_ATTEMPTS = 10
+S3_CONNECT_TIMEOUT = 5
+S3_REQUEST_TIMEOUT = 30
+OUTPUT_BUFFER_SIZE = 16 * pow(2, 20)
+# ZSTD at level 3 writes files about half the size of Snappy at a similar
+# decode speed, so each split rolls over into fewer full-size files
+OUTPUT_COMPRESSION = ENV.str("OUTPUT_COMPRESSION", default="zstd")
+OUTPUT_COMPRESSION_LEVEL = 3 if OUTPUT_COMPRESSION.lower() == "zstd" else None
+# Coalesce column chunk reads into fewer, larger ranged GETs issued in
+# parallel, rather than one read per column chunk
+PARQUET_FORMAT = ds.ParquetFileFormat(
+    default_fragment_scan_options=ds.ParquetFragmentScanOptions(
+        pre_buffer=True
+    )
+)
 
-SKIP_SOURCE_TYPE_CURRENT_MONTH = ENV.list(
-    "SKIP_SOURCE_TYPE_CURRENT_MONTH", default=["AWS", "Azure"]
+BASE_FILE_NAME_REGEX = re.compile(r"source=([^/]*)")
+
+SKIP_SOURCE_TYPE_CURRENT_MONTH = tuple(
+    ENV.list("SKIP_SOURCE_TYPE_CURRENT_MONTH", default=["AWS", "Azure"])
 )
 
 
+class DeleteObjectsError(Exception):
+    """Raised when S3 reports keys that it failed to delete."""
+
+
 class S3ParquetCompactor:
     """Compact Parquet files in S3 based on their path."""
 
@@ -37,154 +102,251 @@ class S3ParquetCompactor:
         aws_access_key=None,
         aws_secret_key=None,
     ) -> None:
+        self.endpoint = endpoint
+        self.aws_access_key = aws_access_key
+        self.aws_secret_key = aws_secret_key
+        fs_kwargs = {
+            "endpoint_override": endpoint,
+            "connect_timeout": S3_CONNECT_TIMEOUT,
+            "request_timeout": S3_REQUEST_TIMEOUT,
+            "retry_strategy": AwsStandardS3RetryStrategy(
+                max_attempts=S3_MAX_ATTEMPTS
+            ),
+        }
         if aws_access_key and aws_secret_key:
-            self.session = boto3.Session(
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-            )
-            self.client = self.session.client("s3", endpoint_url=endpoint)
-            self.s3 = self.session.resource("s3", endpoint_url=endpoint)
-        else:
-            self.session = None
-            self.client = boto3.client("s3", endpoint_url=endpoint)
-            self.s3 = boto3.resource("s3", endpoint_url=endpoint)
+            fs_kwargs["access_key"] = aws_access_key
+            fs_kwargs["secret_key"] = aws_secret_key
+        self.fs = S3FileSystem(**fs_kwargs)
         self.bucket = bucket
         self.path_prefix = f"s3://{self.bucket}/"
         self.data_prefix = data_prefix
-        wr.config.s3_endpoint_url = endpoint
         msg = f"Initialzed S3ParquetCompactor for {self.path_prefix}"
         LOG.info(msg)
 
+    def __getstate__(self) -> dict:
+        """Drop the boto3 client, which cannot be pickled.
+
+        It is created again on first use after unpickling. The Arrow
+        filesystem pickles with its configuration.
+        """
+        state = self.__dict__.copy()
+        state.pop("client", None)
+        return state
+
     @cached_property
-    def current_year_str(self):
-        """Return the current year as a string."""
-        return datetime.datetime.utcnow().strftime("%Y")
+    def client(self):
+        """Return the boto3 S3 client used for listing and deleting.
+
+        Reads and writes go through Arrow's C++ S3 filesystem instead.
+        """
+        if self.aws_access_key and self.aws_secret_key:
+            session = boto3.Session(
+                aws_access_key_id=self.aws_access_key,
+                aws_secret_access_key=self.aws_secret_key,
+            )
+        else:
+            session = boto3.Session()
+        # The client is shared by every worker thread, so give it enough
+        # pooled connections that workers do not queue behind each other,
+        # with headroom for a listing and a delete in flight per worker.
+        config = Config(
+            max_pool_connections=max(
+                S3_MAX_POOL_CONNECTIONS, COMPACTION_WORKERS * 2
+            ),
+            retries={"mode": "adaptive", "max_attempts": S3_MAX_ATTEMPTS},
+        )
+        return session.client("s3", endpoint_url=self.endpoint, config=config)
+
+    def _fs_path(self, key) -> str:
+        """Return an object key as a bucket/key path for the Arrow fs."""
+        return f"{self.bucket}/{key}"
 
     @cached_property
-    def current_month_str(self):
-        """Return the current month as a string."""
-        return datetime.datetime.utcnow().strftime("%m")
+    def current_month_tokens(self):
+        """Return the path tokens that mark current month data."""
+        now = datetime.datetime.utcnow()
+        return (now.strftime("year=%Y"), now.strftime("month=%m"))
 
     def get_common_prefixes(self, prefix) -> list:
         """Return common prefixes in the bucket"""
-        prefixes = []
-        paginator = self.client.get_paginator("list_objects")
-        result = paginator.paginate(
-            Bucket=self.bucket, Prefix=prefix, Delimiter="/"
-        )
-        for prefix in result.search("CommonPrefixes"):
-            if prefix:
-                prefixes.append(prefix.get("Prefix"))
+        _, prefixes = self.list_files_by_prefix(prefix, delimiter="/")
         return prefixes
 
-    def get_common_prefixes_recursive(self, prefix) -> list:
-        """Return file lists at the leaf nodes in the bucket"""
-        results = []
+    def list_files_by_prefix(self, prefix, delimiter=None) -> tuple:
+        """Return the files under the prefix grouped by "directory".
+
+        Without a delimiter this is one flat listing of everything below
+        the prefix, which needs far fewer S3 round trips than walking the
+        tree one level at a time. Only leaf "directories" are returned,
+        files next to a sub-directory are left alone, as they were by the
+        recursive crawl. With a delimiter only the files directly under the
+        prefix are returned, along with its sub-prefixes.
+        """
+        files_by_prefix = defaultdict(list)
+        sub_prefixes = []
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        if delimiter:
+            kwargs["Delimiter"] = delimiter
         paginator = self.client.get_paginator("list_objects_v2")
-        result = paginator.paginate(
-            Bucket=self.bucket, Prefix=prefix, Delimiter="/"
-        )
-        common_prefixes = list(result.search("CommonPrefixes"))
-        if common_prefixes == [None]:
-            results.append({prefix: list(result.search("Contents"))})
-        else:
-            for common_prefix in common_prefixes:
-                if common_prefix is None:
-                    continue
-                results.extend(
-                    self.get_common_prefixes_recursive(
-                        common_prefix.get("Prefix")
-                    )
-                )
-        return results
+        for page in paginator.paginate(
+            PaginationConfig={"PageSize": 1000}, **kwargs
+        ):
+            self.group_by_prefix(page, files_by_prefix)
+            sub_prefixes.extend(
+                common_prefix.get("Prefix")
+                for common_prefix in page.get("CommonPrefixes", [])
+            )
+        if not delimiter:
+            parents = {
+                parent
+                for file_prefix in files_by_prefix
+                for parent in self.parent_prefixes(file_prefix)
+            }
+            for parent in parents:
+                files_by_prefix.pop(parent, None)
+        return files_by_prefix, sub_prefixes
+
+    @staticmethod
+    def parent_prefixes(prefix):
+        """Yield every parent "directory" of prefix."""
+        parent = prefix.rstrip("/")
+        while "/" in parent:
+            parent = parent.rsplit("/", 1)[0]
+            yield parent + "/"
+
+    @staticmethod
+    def group_by_prefix(page, files_by_prefix) -> None:
+        """Add the files of a listing page to their "directory" group."""
+        for content in page.get("Contents", []):
+            key = content["Key"]
+            if key.endswith("/"):
+                continue
+            files_by_prefix[key.rsplit("/", 1)[0] + "/"].append(content)
 
     def convert_results(self, results) -> list:
-        """Convert the dictionary from boto to the info we want"""
+        """Convert the dictionary from boto to the info we want.
+
+        Files are kept as bare object keys, which is what the Arrow
+        filesystem and DeleteObjects take. Only the leaf path is a full
+        s3:// URI, for the logs.
+        """
         new_results = []
+        path_prefix = self.path_prefix
 
         for result in results:
             for key, values in result.items():
-                file_keys = []
-                for value in values:
-                    if value is None:
-                        continue
-                    file_size = value.get("Size")
-                    if file_size >= FILE_SIZE_BYTES:
-                        continue
-                    file_keys.append(
-                        (
-                            self.path_prefix + value.get("Key"),
-                            file_size,
-                            value.get("LastModified"),
-                        )
+                file_keys = [
+                    (
+                        value["Key"],
+                        value["Size"],
+                        value["LastModified"],
                     )
-                new_results.append({self.path_prefix + key: file_keys})
+                    for value in values
+                    if value["Size"] < COMPACTED_FILE_SIZE_BYTES
+                ]
+                # A lone small file, or only empty ones, has nothing to be
+                # merged with, so keep the leaf out of the pipeline entirely
+                if len(file_keys) < 2 or not any(
+                    file_size for _, file_size, _ in file_keys
+                ):
+                    continue
+                new_results.append({path_prefix + key: file_keys})
         return new_results
 
     def determine_file_splits(self, file_tuples) -> list:
-        """Return a list of lists."""
-        split_dict = defaultdict(list)
-        size_dict = defaultdict(float)
-
-        split_count = 1
-        # Loop through our list of files in this S3 "directory"
-        for file_tuple in file_tuples:
-            file_key = file_tuple[0]
-            file_size = file_tuple[1]
-            file_inserted = False
-            # See if this file can be combined with another
-            for i in range(split_count):
-                if size_dict[i] + file_size <= FILE_SIZE_BYTES:
-                    split_dict[i].append(file_key)
-                    size_dict[i] += file_size
-                    file_inserted = True
-            if not file_inserted:
+        """Return a list of lists.
+
+        Files are packed Worst-Fit-Decreasing into splits of at most
+        SPLIT_SIZE_BYTES of input: largest files first, each placed in the
+        split with the most remaining room, or in a new split if even that
+        one cannot hold it. The output size is left to write_merged_files.
+        """
+        # If even the two smallest files overshoot a split together, every
+        # split would hold a single file, so there is nothing to pack
+        smallest = heapq.nsmallest(
+            2, (file_tuple[1] for file_tuple in file_tuples)
+        )
+        if len(smallest) < 2 or sum(smallest) > SPLIT_SIZE_BYTES:
+            return []
+        splits = []
+        # Min-heap of (-remaining_bytes, split_index), so the split with the
+        # most room left (the worst fit) is always on top
+        remaining_heap = []
+        for file_key, file_size, *_ in sorted(
+            file_tuples, key=lambda file_tuple: file_tuple[1], reverse=True
+        ):
+            if remaining_heap and -remaining_heap[0][0] >= file_size:
+                remaining, index = heapq.heappop(remaining_heap)
+                splits[index].append(file_key)
+                heapq.heappush(remaining_heap, (remaining + file_size, index))
+            else:
                 # Insert the file into a new bin
-                split_dict[split_count].append(file_key)
-                size_dict[split_count] += file_size
-                split_count += 1
-
-        return [
-            file_list
-            for file_list in split_dict.values()
-            if len(file_list) > 1
-        ]
+                heapq.heappush(
+                    remaining_heap, (file_size - SPLIT_SIZE_BYTES, len(splits))
+                )
+                splits.append([file_key])
 
-    def merge_files_in_dataframe(self, s3_path, file_name, file_list) -> None:
-        """Return a Pandas DataFrame with merged data from multiple files"""
-        success = True
+        return [file_list for file_list in splits if len(file_list) > 1]
+
+    def group_by_schema(self, s3_path, file_list) -> list:
+        """Return (schema, files) pairs of file_list grouped by schema.
+
+        Only the footers are read, once per path, and the schemas are
+        reused by every split of the path. Files with different schemas
+        are never merged together, so an upstream schema change does not
+        block compaction of the whole path.
+
+        Files are grouped on their schema without its metadata, which is
+        unhashable and, for pandas written files, differs per file. The
+        full schema of the first file in a group is kept for the writer.
+        """
+        files_by_schema = {}
+        try:
+            # Fragments are made directly rather than through ds.dataset,
+            # whose factory stats every file and opens one to infer a
+            # schema. The sizes are already known from the listing.
+            fragments = [
+                PARQUET_FORMAT.make_fragment(
+                    self._fs_path(file), filesystem=self.fs
+                )
+                for file in file_list
+            ]
+            with ThreadPoolExecutor(
+                max_workers=min(len(fragments), COMPACTION_WORKERS)
+            ) as executor:
+                schemas = executor.map(
+                    attrgetter("physical_schema"), fragments
+                )
+                for file, schema in zip(file_list, schemas):
+                    key = schema.remove_metadata()
+                    if key not in files_by_schema:
+                        files_by_schema[key] = (schema, [])
+                    files_by_schema[key][1].append(file)
+        except (ArrowException, OSError) as err:
+            msg = f"Failed to read parquet footers at {s3_path}."
+            LOG.warning(msg)
+            LOG.warning(err)
+            return []
+
+        if len(files_by_schema) > 1:
+            msg = (
+                f"Found {len(files_by_schema)} different schemas at "
+                f"{s3_path}. Merging files with the same schema together."
+            )
+            LOG.warning(msg)
+        return list(files_by_schema.values())
+
+    def merge_files_arrow(self, s3_path, file_name, file_list, schema) -> list:
+        """Return the files that were successfully merged"""
         msg = f"Reading {len(file_list)} number of files from S3: {file_list}"
         LOG.info(msg)
-        for df in wr.s3.read_parquet(
-            path=file_list, boto3_session=self.session, chunked=CHUNKED_ROWS
-        ):
-            file_path = f"{s3_path}{file_name}_{uuid.uuid4().hex}.parquet"
-            try:
-                msg = f"Combining files. Writing file {file_path}"
-                LOG.info(msg)
-                wr.s3.to_parquet(
-                    df=df,
-                    path=file_path,
-                    compression="snappy",
-                    dataset=False,
-                    boto3_session=self.session,
-                )
-            except (ArrowException, EmptyDataFrame) as err:
-                msg = f"Failed to merge parquet files at {s3_path}."
-                LOG.warning(msg)
-                LOG.warning(err)
-                success = False
-            finally:
-                # Force a free up on memory
-                del df
-                gc.collect()
-        return success
+        return self.merge_row_groups(s3_path, file_name, file_list, schema)
 
-    def merge_files_in_dataframe_gcp(
-        self, s3_path, file_name, file_list
-    ) -> None:
-        """Return a boolean whether files were successfully merged"""
-        success = True
+    def merge_files_arrow_gcp(
+        self, s3_path, file_name, file_list, schema
+    ) -> list:
+        """Return the files that were successfully merged"""
+        merged_files = []
         invoice_month = file_list[0].split("_")[0].split("/")[-1]
         dates = sorted({f.split("_")[1] for f in file_list})
         files_per_date = {}
@@ -197,48 +359,168 @@ class S3ParquetCompactor:
                 f" number of files from S3: {file_list}"
             )
             LOG.info(msg)
-            for df in wr.s3.read_parquet(
-                path=file_list,
-                boto3_session=self.session,
-                chunked=CHUNKED_ROWS,
-            ):
-                file_path = (
-                    f"{s3_path}{invoice_month}_{date}"
-                    f"_{uuid.uuid4().hex}.parquet"
+            merged_files.extend(
+                self.merge_row_groups(
+                    s3_path, f"{invoice_month}_{date}", file_list, schema
                 )
-                try:
-                    msg = f"Combining files. Writing file {file_path}"
-                    LOG.info(msg)
-                    wr.s3.to_parquet(
-                        df=df,
-                        path=file_path,
-                        compression="snappy",
-                        dataset=False,
-                        boto3_session=self.session,
-                    )
-                except (ArrowException, EmptyDataFrame) as err:
-                    msg = f"Failed to merge parquet files at {s3_path}."
-                    LOG.warning(msg)
-                    LOG.warning(err)
-                    success = False
-                finally:
-                    # Force a free up on memory
-                    del df
-                    gc.collect()
+            )
+        return merged_files
+
+    def merge_row_groups(self, s3_path, file_name, file_list, schema) -> list:
+        """Merge file_list, which all share schema, into new files.
+
+        Returns the files that were merged.
+        """
+        if len(file_list) < 2:
+            msg = f"No files to merge with {file_list}."
+            LOG.info(msg)
+            return []
+        fragments = [
+            PARQUET_FORMAT.make_fragment(
+                self._fs_path(file), filesystem=self.fs
+            )
+            for file in file_list
+        ]
+        dataset = ds.FileSystemDataset(
+            fragments, schema, PARQUET_FORMAT, filesystem=self.fs
+        )
+        if self.write_merged_files(s3_path, file_name, dataset):
+            return file_list
+        return []
+
+    def write_merged_files(self, s3_path, file_name, dataset) -> bool:
+        """Stream the rows of dataset into new files under s3_path.
+
+        The record batches are gathered into Arrow Tables of about
+        ROW_GROUP_ROWS rows, each written as one row group. Nothing is ever
+        converted to pandas. A new output file is started once the current
+        one reaches FILE_SIZE_BYTES. If any write fails, the files already
+        written are removed again so the inputs are not duplicated.
+        """
+        success = True
+        key_prefix = s3_path.replace(self.path_prefix, "", 1)
+        written_files = []
+        try:
+            # The scanner decodes ahead on Arrow's thread pools while the
+            # writer encodes and uploads, so reads and writes overlap
+            batches = dataset.to_batches(
+                batch_size=SCAN_BATCH_ROWS,
+                batch_readahead=SCAN_BATCH_READAHEAD,
+                fragment_readahead=SCAN_FRAGMENT_READAHEAD,
+                use_threads=True,
+            )
+            tables = self.coalesce_batches(batches, dataset.schema)
+            table = next(tables, None)
+            while table is not None:
+                file_key = (
+                    f"{key_prefix}{file_name}_{uuid.uuid4().hex}.parquet"
+                )
+                msg = (
+                    "Combining files. Writing file "
+                    f"{self.path_prefix}{file_key}"
+                )
+                LOG.info(msg)
+                written_files.append(file_key)
+                # Buffer ParquetWriter's page sized writes so the S3 stream
+                # uploads multipart parts in large, concurrent chunks
+                with self.fs.open_output_stream(
+                    self._fs_path(file_key), buffer_size=OUTPUT_BUFFER_SIZE
+                ) as sink, pq.ParquetWriter(
+                    sink,
+                    dataset.schema,
+                    compression=OUTPUT_COMPRESSION,
+                    compression_level=OUTPUT_COMPRESSION_LEVEL,
+                ) as writer:
+                    # The writer has already put the header in the sink, so
+                    # every file gets at least one row group before the
+                    # size check, or a tiny target would never progress
+                    while table is not None:
+                        writer.write_table(table)
+                        table = next(tables, None)
+                        if sink.tell() >= FILE_SIZE_BYTES:
+                            break
+        except (ArrowException, OSError) as err:
+            msg = f"Failed to merge parquet files at {s3_path}."
+            LOG.warning(msg)
+            LOG.warning(err)
+            success = False
+            self.remove_partial_files(written_files)
         return success
 
+    def remove_partial_files(self, file_list) -> None:
+        """Remove the output files of a merge that did not complete."""
+        if not file_list:
+            return
+        # Deleted through boto3 rather than the Arrow filesystem, which
+        # would leave an empty directory marker behind
+        try:
+            self._delete_keys(file_list)
+        except (BotoCoreError, ClientError) as err:
+            msg = f"Failed to remove partially merged files: {file_list}"
+            LOG.error(msg)
+            LOG.error(err)
+
+    @staticmethod
+    def coalesce_batches(batches, schema):
+        """Yield Arrow Tables of at least ROW_GROUP_ROWS rows.
+
+        Scanner batches never span input row groups, so small inputs would
+        otherwise be written as equally small output row groups.
+        """
+        pending = []
+        pending_rows = 0
+        for batch in batches:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= ROW_GROUP_ROWS:
+                yield pa.Table.from_batches(pending, schema=schema)
+                pending = []
+                pending_rows = 0
+        if pending:
+            yield pa.Table.from_batches(pending, schema=schema)
+
     def remove_uncompacted_files(self, file_list) -> None:
         """Remove the original small files that have been compacted."""
-        msg = f"Deleting files: {file_list}"
+        msg = f"Deleting files from {self.path_prefix}: {file_list}"
         LOG.info(msg)
-        wr.s3.delete_objects(file_list, boto3_session=self.session)
+        failed_keys = []
+        try:
+            for start in range(0, len(file_list), DELETE_BATCH_SIZE):
+                end = start + DELETE_BATCH_SIZE
+                failed_keys.extend(self._delete_keys(file_list[start:end]))
+        except (BotoCoreError, ClientError) as err:
+            msg = f"Failed to delete compacted files: {file_list}"
+            LOG.error(msg)
+            LOG.error(err)
+            raise
+        # The merged copies of these files already exist, so leaving them
+        # in place would count their rows twice
+        if failed_keys:
+            msg = f"Failed to delete compacted files: {failed_keys}"
+            LOG.error(msg)
+            raise DeleteObjectsError(msg)
+
+    def _delete_keys(self, keys) -> list:
+        """Delete up to DELETE_BATCH_SIZE keys in a single request.
+
+        Returns the keys that S3 reported it could not delete.
+        """
+        response = self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+        for error in response.get("Errors", []):
+            msg = (
+                f"Failed to delete {error.get('Key')}: "
+                f"{error.get('Code')} {error.get('Message')}"
+            )
+            LOG.warning(msg)
+        return [error.get("Key") for error in response.get("Errors", [])]
 
     def determine_base_file_name(self, path) -> str:
         """Return a base file name based on the path"""
-        try:
-            base_file_name = path.split("source=")[1].split("/")[0]
-        except IndexError:
-            base_file_name = "data"
+        match = BASE_FILE_NAME_REGEX.search(path)
+        base_file_name = match.group(1) if match else "data"
         msg = f"Using base file name: {base_file_name}"
         LOG.info(msg)
         return base_file_name
@@ -249,21 +531,18 @@ class S3ParquetCompactor:
         Because AWS and Azure data are overwritten during the current month,
         the compacted files would be deleted on the next processing run.
         """
-        is_current_month_data = (
-            f"year={self.current_year_str}" in path
-            and f"month={self.current_month_str}" in path
-        )
-        is_skippable_source_type = any(
+        if not all(token in path for token in self.current_month_tokens):
+            return False
+        return any(
             source_type in path
             for source_type in SKIP_SOURCE_TYPE_CURRENT_MONTH
         )
-        return is_current_month_data and is_skippable_source_type
 
     def filter_compacted(self, basename, file_tuple):
         """Remove any files that already contain the basename except the last
         file in the list.
 
-        The last file probably does not contain the full CHUNKED_ROWS, so it
+        The last file probably did not reach the full FILE_SIZE_BYTES, so it
         can be compacted again.
 
         Skip incomplete files
@@ -273,12 +552,13 @@ class S3ParquetCompactor:
             f"{[t[0] for t in file_tuple]}"
         )
         check_date = datetime.datetime.utcnow() + relativedelta(days=-5)
+        compacted_regex = re.compile(
+            f"/{re.escape(basename)}_(?:[0-9a-f]{{32}}|[0-9]+)\\.parquet$"
+        )
         result = []
         compacted = []
         for file, _, last_modified in file_tuple:
-            regex1 = re.compile(f"/{basename}_[0-9a-f]{{32}}.parquet")
-            regex2 = re.compile(f"/{basename}_[0-9]+.parquet")
-            if regex1.search(file) or regex2.search(file):
+            if compacted_regex.search(file):
                 compacted.append((file, last_modified))
             else:
                 # non-matching regex pattern indicates a new file
@@ -296,33 +576,110 @@ class S3ParquetCompactor:
         """Crawl the S3 bucket and compact parquet files."""
         account_level_prefixes = self.get_common_prefixes(self.data_prefix)
 
-        for prefix in account_level_prefixes:
-            msg = f"Handling prefix: {prefix}"
-            LOG.info(msg)
-            results = self.get_common_prefixes_recursive(prefix)
-            results = self.convert_results(results)
-            for result in results:
-                for path, file_tuples in result.items():
-                    if self.should_skip_compacting(path):
-                        msg = f"Skipping compacting for {path}."
-                        LOG.info(msg)
+        with ThreadPoolExecutor(max_workers=COMPACTION_WORKERS) as executor:
+            # Each account prefix is listed one level deep and its
+            # sub-prefixes are then listed flat, all on the same pool.
+            # Leaf paths are queued as soon as they are listed, so
+            # compaction starts while the rest of the bucket is crawled.
+            listing_futures = set()
+            for prefix in account_level_prefixes:
+                msg = f"Handling prefix: {prefix}"
+                LOG.info(msg)
+                listing_futures.add(
+                    executor.submit(self.list_files_by_prefix, prefix, "/")
+                )
+            compaction_futures = []
+            while listing_futures:
+                done, listing_futures = wait(
+                    listing_futures, return_when=FIRST_COMPLETED
+                )
+                for listing_future in done:
+                    files_by_prefix, sub_prefixes = listing_future.result()
+                    for sub_prefix in sub_prefixes:
+                        listing_futures.add(
+                            executor.submit(
+                                self.list_files_by_prefix, sub_prefix
+                            )
+                        )
+                    # Files directly under an account prefix are only a
+                    # leaf when it has no sub-prefixes
+                    if sub_prefixes:
                         continue
-                    msg = f"Determing file compaction for {path}"
-                    LOG.info(msg)
-                    base_file_name = self.determine_base_file_name(path)
-                    file_list = self.filter_compacted(
-                        base_file_name, file_tuples
+                    results = self.convert_results([files_by_prefix])
+                    for result in results:
+                        for path, file_tuples in result.items():
+                            compaction_futures.append(
+                                executor.submit(
+                                    self.compact_path, path, file_tuples
+                                )
+                            )
+            for count, future in enumerate(
+                as_completed(compaction_futures), start=1
+            ):
+                future.result()
+                msg = f"Finished {count} of {len(compaction_futures)} paths"
+                LOG.info(msg)
+
+    def compact_path(self, path, file_tuples) -> None:
+        """Compact the parquet files in a single leaf path."""
+        if self.should_skip_compacting(path):
+            msg = f"Skipping compacting for {path}."
+            LOG.info(msg)
+            return
+        msg = f"Determing file compaction for {path}"
+        LOG.info(msg)
+        base_file_name = self.determine_base_file_name(path)
+        file_list = self.filter_compacted(base_file_name, file_tuples)
+        if len(file_list) <= 1:
+            LOG.info("No files to compact. Skipping compaction.")
+            return
+        file_sizes = {
+            file_key: file_size for file_key, file_size, _ in file_tuples
+        }
+        total_size = sum(file_sizes[file] for file in file_list)
+        if total_size < MIN_COMPACTION_BYTES:
+            msg = (
+                f"Only {total_size} bytes to compact at {path}. "
+                "Skipping compaction."
+            )
+            LOG.info(msg)
+            return
+        merge_files = (
+            self.merge_files_arrow_gcp
+            if "GCP" in path
+            else self.merge_files_arrow
+        )
+        with ThreadPoolExecutor(max_workers=SPLIT_WORKERS) as executor:
+            merge_futures = []
+            for schema, schema_files in self.group_by_schema(path, file_list):
+                # Pack the files by size so each split makes roughly one
+                # output file of the target size, and a failed split only
+                # holds back its own inputs
+                file_splits = self.determine_file_splits(
+                    [(file, file_sizes[file]) for file in schema_files]
+                )
+                if not file_splits:
+                    LOG.info("No files can be combined. Skipping compaction.")
+                    continue
+                merge_futures.extend(
+                    executor.submit(
+                        merge_files, path, base_file_name, file_split, schema
                     )
-                    if len(file_list) <= 1:
-                        LOG.info("No files to compact. Skipping compaction.")
-                        continue
-                    if "GCP" in path:
-                        success = self.merge_files_in_dataframe_gcp(
-                            path, base_file_name, file_list
-                        )
-                    else:
-                        success = self.merge_files_in_dataframe(
-                            path, base_file_name, file_list
-                        )
-                    if success:
-                        self.remove_uncompacted_files(file_list)
+                    for file_split in file_splits
+                )
+            # A split's inputs are deleted only once its outputs are closed.
+            # Later splits may already be merged when an earlier one fails,
+            # so their inputs are still deleted before the error is raised.
+            errors = []
+            for merge_future in merge_futures:
+                try:
+                    merged_files = merge_future.result()
+                    if merged_files:
+                        self.remove_uncompacted_files(merged_files)
+                except Exception as err:
+                    msg = f"Failed to compact a split of {path}."
+                    LOG.error(msg)
+                    LOG.error(err)
+                    errors.append(err)
+        if errors:
+            raise errors[0]
@@ -0,0 +1,362 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from parquet_compactor import DeleteObjectsError
+from parquet_compactor import S3ParquetCompactor
+from pyarrow.fs import LocalFileSystem
+
+
+class LocalCompactorTestCase(unittest.TestCase):
+    """Base for tests that read and write parquet files locally."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.compactor = S3ParquetCompactor(
+            "bucket", "http://localhost:9000", "data/parquet/"
+        )
+        # _fs_path joins the bucket and key, so a local directory stands in
+        # for the bucket
+        self.compactor.bucket = self.tmp_dir.name
+        self.compactor.fs = LocalFileSystem()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_pandas_file(self, key, start):
+        """Write a small pandas parquet file, with its pandas metadata."""
+        data_frame = pd.DataFrame(
+            {"a": range(start, start + 3), "s": ["x", "y", "z"]},
+            index=range(start, start + 3),
+        )
+        data_frame.to_parquet(os.path.join(self.tmp_dir.name, key))
+        return key
+
+
+class GroupBySchemaTest(LocalCompactorTestCase):
+    """Tests for S3ParquetCompactor.group_by_schema."""
+
+    def test_pandas_written_files(self):
+        """Test that files with pandas metadata are grouped together."""
+        files = [
+            self.write_pandas_file(f"f{i}.parquet", i * 3) for i in range(3)
+        ]
+        schemas = [
+            pq.read_schema(os.path.join(self.tmp_dir.name, file))
+            for file in files
+        ]
+        self.assertIn(b"pandas", schemas[0].metadata)
+        self.assertNotEqual(schemas[0].metadata, schemas[1].metadata)
+
+        groups = self.compactor.group_by_schema("s3://bucket/", files)
+
+        self.assertEqual(len(groups), 1)
+        schema, schema_files = groups[0]
+        self.assertEqual(schema_files, files)
+        self.assertEqual(schema.metadata, schemas[0].metadata)
+
+    def test_different_schemas(self):
+        """Test that files with different columns are grouped apart."""
+        files = [self.write_pandas_file("f0.parquet", 0)]
+        other = "other.parquet"
+        pd.DataFrame({"b": [1.0]}).to_parquet(
+            os.path.join(self.tmp_dir.name, other)
+        )
+        files.append(other)
+
+        groups = self.compactor.group_by_schema("s3://bucket/", files)
+
+        self.assertEqual(
+            sorted(schema_files for _, schema_files in groups),
+            [["f0.parquet"], ["other.parquet"]],
+        )
+
+
+class CompactPathTest(LocalCompactorTestCase):
+    """Tests for S3ParquetCompactor.compact_path."""
+
+    def test_compact_path_merges_pandas_files(self):
+        """Test that files differing only in pandas metadata are merged."""
+        os.mkdir(os.path.join(self.tmp_dir.name, "source=x"))
+        files = [
+            self.write_pandas_file(f"source=x/f{i}.parquet", i * 3)
+            for i in range(3)
+        ]
+        file_tuples = [
+            (
+                file,
+                os.path.getsize(os.path.join(self.tmp_dir.name, file)),
+                datetime(2020, 1, 1),
+            )
+            for file in files
+        ]
+
+        with patch.object(self.compactor, "_delete_keys") as delete_keys:
+            self.compactor.compact_path("s3://bucket/source=x/", file_tuples)
+
+        delete_keys.assert_called_once()
+        self.assertEqual(sorted(delete_keys.call_args[0][0]), files)
+        outputs = [
+            name
+            for name in os.listdir(os.path.join(self.tmp_dir.name, "source=x"))
+            if name.startswith("x_")
+        ]
+        self.assertEqual(len(outputs), 1)
+        table = pq.read_table(
+            os.path.join(self.tmp_dir.name, "source=x", outputs[0])
+        )
+        self.assertEqual(sorted(table.column("a").to_pylist()), list(range(9)))
+
+    def test_compact_path_deletes_after_failed_split(self):
+        """Test that a failed split does not keep later splits' inputs."""
+        files = [f"source=x/f{i}.parquet" for i in range(4)]
+        file_tuples = [(file, 10, datetime(2020, 1, 1)) for file in files]
+        splits = [files[:2], files[2:]]
+        error = ClientError({"Error": {"Code": "500"}}, "DeleteObjects")
+
+        with patch.object(
+            self.compactor, "group_by_schema", return_value=[(None, files)]
+        ), patch.object(
+            self.compactor, "determine_file_splits", return_value=splits
+        ), patch.object(
+            self.compactor,
+            "merge_files_arrow",
+            side_effect=lambda path, name, file_list, schema: file_list,
+        ), patch.object(
+            self.compactor, "_delete_keys", side_effect=[error, []]
+        ) as delete_keys:
+            with self.assertRaises(ClientError):
+                self.compactor.compact_path(
+                    "s3://bucket/source=x/", file_tuples
+                )
+
+        self.assertEqual(
+            [call[0][0] for call in delete_keys.call_args_list], splits
+        )
+
+
+class WriteMergedFilesTest(LocalCompactorTestCase):
+    """Tests for S3ParquetCompactor.write_merged_files."""
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir(os.path.join(self.tmp_dir.name, "source=x"))
+        self.files = [
+            self.write_pandas_file(f"source=x/f{i}.parquet", i * 3)
+            for i in range(3)
+        ]
+        self.schema = pq.read_schema(
+            os.path.join(self.tmp_dir.name, self.files[0])
+        )
+
+    def outputs(self):
+        """Return the merged output files, sorted by name."""
+        return sorted(
+            name
+            for name in os.listdir(os.path.join(self.tmp_dir.name, "source=x"))
+            if name.startswith("x_")
+        )
+
+    @patch("parquet_compactor.ROW_GROUP_ROWS", 3)
+    @patch("parquet_compactor.FILE_SIZE_BYTES", 1)
+    def test_rolls_over_at_file_size(self):
+        """Test that a new file is started once one reaches the target."""
+        merged = self.compactor.merge_row_groups(
+            "s3://bucket/source=x/", "x", self.files, self.schema
+        )
+
+        self.assertEqual(merged, self.files)
+        outputs = self.outputs()
+        self.assertEqual(len(outputs), 3)
+        rows = []
+        for output in outputs:
+            table = pq.read_table(
+                os.path.join(self.tmp_dir.name, "source=x", output)
+            )
+            self.assertEqual(table.num_rows, 3)
+            rows.extend(table.column("a").to_pylist())
+        self.assertEqual(sorted(rows), list(range(9)))
+
+    @patch("parquet_compactor.FILE_SIZE_BYTES", 1)
+    def test_failed_write_removes_partial_files(self):
+        """Test that the files of a failed merge are removed again."""
+        table = pq.read_table(os.path.join(self.tmp_dir.name, self.files[0]))
+
+        def coalesce_batches(batches, schema):
+            yield table
+            raise pa.ArrowInvalid("corrupt input")
+
+        with patch.object(
+            self.compactor, "coalesce_batches", side_effect=coalesce_batches
+        ), patch.object(self.compactor, "_delete_keys") as delete_keys:
+            merged = self.compactor.merge_row_groups(
+                "s3://bucket/source=x/", "x", self.files, self.schema
+            )
+
+        self.assertEqual(merged, [])
+        outputs = self.outputs()
+        self.assertEqual(len(outputs), 1)
+        delete_keys.assert_called_once_with([f"source=x/{outputs[0]}"])
+
+
+class FileSplitsTest(unittest.TestCase):
+    """Tests for S3ParquetCompactor.determine_file_splits."""
+
+    def setUp(self):
+        self.compactor = S3ParquetCompactor(
+            "bucket", "http://localhost:9000", "data/parquet/"
+        )
+
+    @patch("parquet_compactor.SPLIT_SIZE_BYTES", 40)
+    @patch("parquet_compactor.FILE_SIZE_BYTES", 10)
+    def test_splits_hold_several_output_files(self):
+        """Test that a split is filled by input size, not the file target."""
+        file_tuples = [(f"f{i}.parquet", 10) for i in range(8)]
+
+        splits = self.compactor.determine_file_splits(file_tuples)
+
+        self.assertEqual([len(split) for split in splits], [4, 4])
+
+    @patch("parquet_compactor.SPLIT_SIZE_BYTES", 10)
+    def test_worst_fit_decreasing(self):
+        """Test that every file is packed exactly once within a split."""
+        sizes = {f"f{size}.parquet": size for size in (2, 7, 4, 6, 3, 5)}
+
+        splits = self.compactor.determine_file_splits(list(sizes.items()))
+
+        self.assertEqual(
+            sorted(sorted(split) for split in splits),
+            [
+                ["f2.parquet", "f7.parquet"],
+                ["f3.parquet", "f6.parquet"],
+                ["f4.parquet", "f5.parquet"],
+            ],
+        )
+        packed = [file for split in splits for file in split]
+        self.assertEqual(sorted(packed), sorted(sizes))
+        for split in splits:
+            self.assertLessEqual(sum(sizes[file] for file in split), 10)
+
+    @patch("parquet_compactor.SPLIT_SIZE_BYTES", 10)
+    def test_no_two_files_fit(self):
+        """Test that nothing is packed when no two files fit together."""
+        file_tuples = [("a.parquet", 6), ("b.parquet", 7), ("c.parquet", 9)]
+
+        with patch("parquet_compactor.heapq.heappush") as heappush:
+            splits = self.compactor.determine_file_splits(file_tuples)
+
+        self.assertEqual(splits, [])
+        heappush.assert_not_called()
+
+    def test_single_file(self):
+        """Test that a lone file is never split."""
+        splits = self.compactor.determine_file_splits([("a.parquet", 1)])
+
+        self.assertEqual(splits, [])
+
+
+class ListingTest(unittest.TestCase):
+    """Tests for listing the leaf paths to compact."""
+
+    keys = [
+        "data/parquet/acct/a.parquet",
+        "data/parquet/acct/src/b.parquet",
+        "data/parquet/acct/src/c.parquet",
+        "data/parquet/acct/src/sub/d.parquet",
+        "data/parquet/acct/src/sub/e.parquet",
+    ]
+
+    def setUp(self):
+        self.compactor = S3ParquetCompactor(
+            "bucket", "http://localhost:9000", "data/parquet/"
+        )
+        self.compactor.client = MagicMock()
+        paginator = self.compactor.client.get_paginator.return_value
+        paginator.paginate.side_effect = self.paginate
+
+    def paginate(self, Bucket, Prefix, PaginationConfig, Delimiter=None):
+        """Return a single ListObjectsV2 page for the fake bucket."""
+        contents = []
+        common_prefixes = set()
+        for key in self.keys:
+            if not key.startswith(Prefix):
+                continue
+            rest = key.replace(Prefix, "", 1)
+            if Delimiter and Delimiter in rest:
+                sub_prefix = rest.split(Delimiter, 1)[0]
+                common_prefixes.add(f"{Prefix}{sub_prefix}{Delimiter}")
+            else:
+                contents.append(
+                    {
+                        "Key": key,
+                        "Size": 10,
+                        "LastModified": datetime(2020, 1, 1),
+                    }
+                )
+        return [
+            {
+                "Contents": contents,
+                "CommonPrefixes": [
+                    {"Prefix": prefix} for prefix in sorted(common_prefixes)
+                ],
+            }
+        ]
+
+    def test_flat_listing_returns_leaves(self):
+        """Test that files next to a sub-directory are not grouped."""
+        files_by_prefix, _ = self.compactor.list_files_by_prefix(
+            "data/parquet/acct/src/"
+        )
+        self.assertEqual(list(files_by_prefix), ["data/parquet/acct/src/sub/"])
+
+    def test_compact_only_compacts_leaves(self):
+        """Test that only leaf paths are compacted."""
+        with patch.object(self.compactor, "compact_path") as compact_path:
+            self.compactor.compact()
+
+        self.assertEqual(
+            [call[0][0] for call in compact_path.call_args_list],
+            ["s3://bucket/data/parquet/acct/src/sub/"],
+        )
+
+
+class DeleteTest(unittest.TestCase):
+    """Tests for deleting files with DeleteObjects."""
+
+    def setUp(self):
+        self.compactor = S3ParquetCompactor(
+            "bucket", "http://localhost:9000", "data/parquet/"
+        )
+        self.compactor.client = MagicMock()
+        self.compactor.client.delete_objects.return_value = {
+            "Errors": [
+                {"Key": "a.parquet", "Code": "AccessDenied", "Message": ""}
+            ]
+        }
+
+    def test_remove_uncompacted_files_raises_on_errors(self):
+        """Test that keys S3 failed to delete fail the compaction."""
+        with self.assertRaises(DeleteObjectsError):
+            self.compactor.remove_uncompacted_files(["a.parquet", "b.parquet"])
+
+    def test_remove_uncompacted_files(self):
+        """Test that a clean DeleteObjects response does not raise."""
+        self.compactor.client.delete_objects.return_value = {}
+        self.compactor.remove_uncompacted_files(["a.parquet", "b.parquet"])
+        self.compactor.client.delete_objects.assert_called_once()
+
+    def test_remove_partial_files_logs_errors(self):
+        """Test that failing to remove partial outputs only logs."""
+        with self.assertLogs("parquet_compactor", level="WARNING"):
+            self.compactor.remove_partial_files(["a.parquet"])
+
+
+if __name__ == "__main__":
+    unittest.main()